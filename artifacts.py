@@ -0,0 +1,71 @@
+"""Stage the intermediate glm and xml files in memory and remove or archive them after the analysis.
+
+GridlabD reads and writes files, so "in memory" means a tmpfs directory (/dev/shm by default). Once a step is
+analyzed its files are deleted, or gzip-compressed into archive_dir if given (analyze_xml reads .xml.gz
+directly). release() returns the bytes the step wrote to disk, i.e. the archived files plus the staged files
+when no tmpfs is available.
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+
+MEMORY_DIR = '/dev/shm'
+MEMORY_FS = ['tmpfs', 'ramfs']
+
+
+class ArtifactManager():
+    def __init__(self, stage_dir=None, archive_dir=None, compresslevel=6):
+        if stage_dir is None:
+            stage_dir = MEMORY_DIR if os.path.isdir(MEMORY_DIR) else tempfile.gettempdir()
+        self.stage_dir = os.path.join(tempfile.mkdtemp(prefix='pyglm-', dir=stage_dir), '')
+        self.in_memory = is_in_memory(self.stage_dir)
+        self.archive_dir = archive_dir
+        if archive_dir is not None and not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        self.compresslevel = compresslevel
+        self.disk_bytes = 0
+        if not self.in_memory:
+            print 'staging artifacts on disk at %s' % self.stage_dir
+
+    def release(self, files):
+        """Archive (if archive_dir is set) and delete the staged files, return the bytes written to disk."""
+        disk_bytes = 0
+        for staged_file in files:
+            if staged_file is None or not os.path.exists(staged_file):
+                continue
+            if not self.in_memory:
+                disk_bytes += os.path.getsize(staged_file)
+            if self.archive_dir is not None:
+                archive_file = os.path.join(self.archive_dir, os.path.basename(staged_file) + '.gz')
+                with open(staged_file, 'rb') as fr:
+                    with gzip.open(archive_file, 'wb', self.compresslevel) as fw:
+                        shutil.copyfileobj(fr, fw)
+                disk_bytes += os.path.getsize(archive_file)
+            os.remove(staged_file)
+        self.disk_bytes += disk_bytes
+        return disk_bytes
+
+    def close(self):
+        shutil.rmtree(self.stage_dir, ignore_errors=True)
+
+
+def is_in_memory(path):
+    """Whether the path is on a tmpfs/ramfs mount, judged by the longest matching mount point."""
+    path = os.path.realpath(path)
+    fs_type = None
+    mount_len = -1
+    try:
+        mounts = open('/proc/mounts').readlines()
+    except IOError:
+        return False
+    for mount in mounts:
+        fields = mount.split()
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1]
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > mount_len:
+            fs_type = fields[2]
+            mount_len = len(mount_point)
+    return fs_type in MEMORY_FS
@@ -0,0 +1,221 @@
+"""Command line entry point: prepare, write, solve, analyze and run.
+
+Each subcommand imports only the modules it needs, so short jobs do not pay for pandas, matplotlib or psycopg2
+unless they use them. The case files default to the layout of a case directory (topology.json, config.json,
+measurement.csv and result/), e.g.
+
+    python cli.py run --case case/la --start "2015-09-16 10:00:00" --stop "2015-09-16 11:00:00"
+    python cli.py --timing analyze case/la/result/150916-101500.xml
+    python cli.py startup      # startup time of every subcommand
+"""
+
+import time
+
+T_START = time.time()
+
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+
+STEP_FORMAT = '%Y-%m-%d %H:%M:%S'
+GLM_FORMAT = '%y%m%d-%H%M%S'
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib', 'psycopg2']
+
+
+def prepare(args):
+    from la_prepare import prepare_topology
+
+    if args.imports_only:
+        return
+    prepare_topology(args.raw_json, args.topology, args.rules, args.report)
+
+
+def write(args):
+    from glm_writer import GlmModel, MeasurementIndex
+    from simulator import get_steps
+
+    if args.imports_only:
+        return
+    # the glm file names are appended to the directory, so it must end with a separator
+    file_dir = os.path.join(args.out, '') if args.out else _case_file(args, 'result')
+    _make_dir(file_dir)
+    model = GlmModel(_case_file(args, 'topology'), _case_file(args, 'config'))
+    measurement = MeasurementIndex(_case_file(args, 'data'))
+    for step in get_steps(_parse_step(args.start), _parse_step(args.stop), args.interval):
+        measure_snapshot = measurement.get_snapshot(step)
+        if measure_snapshot is None:
+            print 'no such file - %s' % step
+            continue
+        model.write_glm(step, measure_snapshot, file_dir)
+
+
+def solve(args):
+    from simulator import run_gridlabd
+
+    if args.imports_only:
+        return
+    for glm_file in args.glm_files:
+        print run_gridlabd(glm_file)
+
+
+def analyze(args):
+    from xml_analyzer import analyze_xml
+
+    if args.imports_only:
+        return
+    rows = []
+    for xml_file in args.xml_files:
+        # the time step is the name given by write_glm, e.g. 150916-101500.xml(.gz)
+        step = os.path.basename(xml_file).split('.')[0]
+        try:
+            step = datetime.datetime.strptime(step, GLM_FORMAT)
+        except ValueError:
+            pass
+        result = analyze_xml(xml_file, step)
+        if result is None:
+            print 'no such file - %s' % xml_file
+            continue
+        rows.append(result)
+    write_summary(rows, args.summary)
+
+
+def run(args):
+    from artifacts import ArtifactManager
+    from glm_writer import GlmModel, MeasurementIndex
+    from simulator import get_steps, solve_step
+
+    if args.imports_only:
+        return
+    model = GlmModel(_case_file(args, 'topology'), _case_file(args, 'config'))
+    measurement = MeasurementIndex(_case_file(args, 'data'))
+    artifacts = ArtifactManager(args.stage_dir, args.archive_dir)
+    rows = []
+    t = time.time()
+    steps = get_steps(_parse_step(args.start), _parse_step(args.stop), args.interval)
+    try:
+        for step in steps:
+            measure_snapshot = measurement.get_snapshot(step)
+            if measure_snapshot is None:
+                print 'no such file - %s' % step
+                continue
+            result = solve_step(_case_file(args, 'topology'), _case_file(args, 'config'), step,
+                                _case_file(args, 'data'), None, artifacts, model, measure_snapshot)
+            if result is None:
+                print 'solve failed - %s' % step
+                continue
+            rows.append(result)
+    finally:
+        artifacts.close()
+    print 'run avg time %f s, disk bytes written %d' % (float(time.time()-t)/max(len(steps), 1),
+                                                        artifacts.disk_bytes)
+    if args.summary is None:
+        _make_dir(_case_file(args, 'result'))
+    write_summary(rows, args.summary or os.path.join(_case_file(args, 'result'), 'line_loss_summary.csv'))
+
+
+def startup(args):
+    """Measure the wall time of starting each subcommand (interpreter, imports) in a fresh process."""
+    for command in ['prepare', 'write', 'solve', 'analyze', 'run']:
+        t = time.time()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--imports-only', '--timing',
+                                          command] + STARTUP_ARGS[command], stderr=subprocess.STDOUT)
+        print '%-8s %.3f s  %s' % (command, time.time() - t, output.strip())
+
+
+STARTUP_ARGS = {'prepare': ['raw.json', 'topology.json', '--rules', 'rules.json'],
+                'write': ['--start', '2000-01-01 00:00:00', '--stop', '2000-01-01 00:00:00'],
+                'solve': ['step.glm'],
+                'analyze': ['step.xml'],
+                'run': ['--start', '2000-01-01 00:00:00', '--stop', '2000-01-01 00:00:00']}
+
+
+def write_summary(rows, summary_csv=None):
+    """Write the summary rows as csv to summary_csv, or to stdout."""
+    import csv
+
+    if len(rows) == 0:
+        return
+    f = sys.stdout if summary_csv is None else open(summary_csv, 'w+')
+    writer = csv.DictWriter(f, fieldnames=rows[0].keys(), extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    if summary_csv is not None:
+        f.close()
+
+
+def _parse_step(step):
+    return datetime.datetime.strptime(step, STEP_FORMAT)
+
+
+def _make_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def _case_file(args, name):
+    value = getattr(args, name)
+    if value is not None:
+        # the result directory is used as a file name prefix
+        return os.path.join(value, '') if name == 'result' else value
+    return {'topology': os.path.join(args.case, 'topology.json'),
+            'config': os.path.join(args.case, 'config.json'),
+            'data': os.path.join(args.case, 'measurement.csv'),
+            'result': os.path.join(args.case, 'result', '')}[name]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Write, solve and analyze GridlabD power flow of a case.')
+    parser.add_argument('--timing', action='store_true', help='print the startup time and loaded heavy modules')
+    parser.add_argument('--imports-only', action='store_true', help=argparse.SUPPRESS)
+    subparsers = parser.add_subparsers(dest='command')
+
+    prepare_parser = subparsers.add_parser('prepare', help='prepare topology.json from a raw GIS export')
+    prepare_parser.add_argument('raw_json')
+    prepare_parser.add_argument('topology')
+    prepare_parser.add_argument('--rules', required=True, help='rules file, e.g. case/la/raw/la_rules.json')
+    prepare_parser.add_argument('--report', help='write the report of the changes to this json file')
+    prepare_parser.set_defaults(func=prepare)
+
+    case_parser = argparse.ArgumentParser(add_help=False)
+    case_parser.add_argument('--case', default='case/la', help='case directory')
+    case_parser.add_argument('--topology', help='default CASE/topology.json')
+    case_parser.add_argument('--config', help='default CASE/config.json')
+    case_parser.add_argument('--data', help='default CASE/measurement.csv')
+    case_parser.add_argument('--result', help='default CASE/result/')
+    case_parser.add_argument('--start', required=True, help='first time step, e.g. "2015-09-16 10:00:00"')
+    case_parser.add_argument('--stop', required=True, help='time step to stop before')
+    case_parser.add_argument('--interval', type=int, default=15, help='minutes between time steps')
+
+    write_parser = subparsers.add_parser('write', parents=[case_parser], help='write the glm files')
+    write_parser.add_argument('--out', help='directory of the glm files, default the result directory')
+    write_parser.set_defaults(func=write)
+
+    solve_parser = subparsers.add_parser('solve', help='solve glm files by GridlabD')
+    solve_parser.add_argument('glm_files', nargs='+')
+    solve_parser.set_defaults(func=solve)
+
+    analyze_parser = subparsers.add_parser('analyze', help='summarize the losses of xml (or xml.gz) files')
+    analyze_parser.add_argument('xml_files', nargs='+')
+    analyze_parser.add_argument('--summary', help='summary csv, default stdout')
+    analyze_parser.set_defaults(func=analyze)
+
+    run_parser = subparsers.add_parser('run', parents=[case_parser], help='write, solve and analyze a time range')
+    run_parser.add_argument('--summary', help='summary csv, default RESULT/line_loss_summary.csv')
+    run_parser.add_argument('--stage-dir', help='directory for the intermediate files, default /dev/shm')
+    run_parser.add_argument('--archive-dir', help='keep gzip copies of the intermediate files here')
+    run_parser.set_defaults(func=run)
+
+    startup_parser = subparsers.add_parser('startup', help='measure the startup time of each subcommand')
+    startup_parser.set_defaults(func=startup)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.func(args)
+    if args.timing:
+        loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+        print '%s %.3f s, heavy modules: %s' % ('startup' if args.imports_only else 'elapsed', time.time() - T_START,
+                                                ', '.join(loaded) or 'none')
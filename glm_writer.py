@@ -6,9 +6,10 @@ Modify the physical properties for lines, transformers if necessary.
 from collections import OrderedDict, namedtuple
 import math
 import datetime
+import os
 
 import json
-import pandas
+import numpy
 
 # Physical Properties
 # conductor: radius in ft, resistance in ohm/mile
@@ -33,47 +34,83 @@ SERVICE_DROP_CONFIG = 'SERVICE_DROP_CONFIG'
 # tag put before every node (glm does not support node name starting with numbers)
 TAG_NODE = 'n'
 
+# unmeasured and unidentified nodes take the measurement of the previous node of their area, or this default
+DEFAULT_MEASUREMENT = {'voltage':120,'power_1':100+100j}
 
-def write_glm(topology_json, config_json, time_step, data_csv, file_dir):
-    measure_snapshot = extract_measurement(data_csv, time_step)
+
+def write_glm(topology_json, config_json, time_step, data_csv, file_dir, measure_snapshot=None, tag='',
+              model=None):
+    """Write the glm file of the time step, the measurement is read from data_csv unless measure_snapshot is given.
+
+    tag is appended to the file name, e.g. to tell apart several scenarios of the same time step. Pass a GlmModel
+    of the topology and config when writing many time steps, so they are loaded only once.
+    """
+    if measure_snapshot is None:
+        measure_snapshot = extract_measurement(data_csv, time_step)
     if measure_snapshot is None:
         return None
-    print 'writing %s' % str(time_step)
+    if model is None:
+        model = GlmModel(topology_json, config_json)
+    return model.write_glm(time_step, measure_snapshot, file_dir, tag)
+
+
+class GlmModel():
+    """The topology and config of a case, loaded once to write the glm files of many snapshots.
+
+    Holds the sorted grid lines, the measurement independent part of the glm file and the node injection index.
+    """
+    def __init__(self, topology_json, config_json):
+        self.grid_config, self.grid_lines, transformers = load_grid(topology_json, config_json)
+        self.template = get_glm_template(self.grid_config, self.grid_lines, transformers)
+        self.node_index = NodeInjectionIndex(self.grid_config, get_grid_nodes(self.grid_lines))
 
+    def write_glm(self, time_step, measure_snapshot, file_dir, tag=''):
+        print 'writing %s' % str(time_step)
+        glm_file = file_dir + time_step.strftime("%y%m%d-%H%M%S") + tag + '.glm'
+        with open(glm_file, 'w') as fw:
+            fw.write(self.template)
+            fw.write(self.node_index.render(measure_snapshot))
+        return glm_file
+
+
+def load_grid(topology_json, config_json):
+    """Load the config and the sorted topology, return grid_config, grid_lines and transformers."""
     grid_config = json.load(open(config_json))
     grid_lines = json.load(open(topology_json))
     transformers = grid_lines['tr']
     del grid_lines['tr']
     grid_lines = sort_line_direction(grid_lines, grid_config['area2transformer'])
+    return grid_config, grid_lines, transformers
+
 
-    glm_file = file_dir + time_step.strftime("%y%m%d-%H%M%S") + '.glm'
-    fw = open(glm_file, 'w')
-    fw.write(get_grid_summary(grid_lines, grid_config['area2phase'])[0])
-    fw.write(get_network_flow(grid_lines, grid_config['area2transformer'])[0])
+def get_glm_template(grid_config, grid_lines, transformers):
+    """Return the measurement independent part of the glm file (everything but the nodes)."""
+    blocks = [get_grid_summary(grid_lines, grid_config['area2phase'])[0],
+              get_network_flow(grid_lines, grid_config['area2transformer'])[0]]
 
     glm = GlmFormat()
-    fw.write('// header, clock, and module')
-    fw.write(glm.header)
-    fw.write(glm.clock)
-    fw.write(glm.module)
-
-    fw.write('// physical parameters and properties\n')
-    fw.write(glm.get_line_conductor(MV_CONDUCTOR))
-    fw.write(glm.get_line_spacing(MV_SPACING))
-    fw.write(glm.get_line_config(MV_LINE_CONFIG, MV_CONDUCTOR, MV_SPACING))
-    fw.write(glm.get_line_conductor(LV_CONDUCTOR))
-    fw.write(glm.get_triplex_line_config(LV_LINE_CONFIG, LV_CONDUCTOR, LV_LINE_DIM))
-    fw.write(glm.get_line_conductor(SD_CONDUCTOR))
-    fw.write(glm.get_triplex_line_config(SERVICE_DROP_CONFIG, SD_CONDUCTOR, LV_LINE_DIM))
-
-    fw.write('// transformers\n')
+    blocks.append('// header, clock, and module')
+    blocks.append(glm.header)
+    blocks.append(glm.clock)
+    blocks.append(glm.module)
+
+    blocks.append('// physical parameters and properties\n')
+    blocks.append(glm.get_line_conductor(MV_CONDUCTOR))
+    blocks.append(glm.get_line_spacing(MV_SPACING))
+    blocks.append(glm.get_line_config(MV_LINE_CONFIG, MV_CONDUCTOR, MV_SPACING))
+    blocks.append(glm.get_line_conductor(LV_CONDUCTOR))
+    blocks.append(glm.get_triplex_line_config(LV_LINE_CONFIG, LV_CONDUCTOR, LV_LINE_DIM))
+    blocks.append(glm.get_line_conductor(SD_CONDUCTOR))
+    blocks.append(glm.get_triplex_line_config(SERVICE_DROP_CONFIG, SD_CONDUCTOR, LV_LINE_DIM))
+
+    blocks.append('// transformers\n')
     for transformer in transformers:
         phase = grid_config['area2phase'][transformer['area_low']]
         trans_config = '%s_%s_%s' % (transformer['transformer'], phase, str(transformer['b']))
-        fw.write(glm.get_trans_config(trans_config, phase))
-        fw.write(glm.get_trans(phase, transformer, trans_config))
+        blocks.append(glm.get_trans_config(trans_config, phase))
+        blocks.append(glm.get_trans(phase, transformer, trans_config))
 
-    fw.write('// lines\n')
+    blocks.append('// lines\n')
     for sub, lines in grid_lines.items():
         phase = grid_config['area2phase'][sub]
         if 'mv' in sub:
@@ -89,9 +126,11 @@ def write_glm(topology_json, config_json, time_step, data_csv, file_dir):
             if 'sd' in line:
                 config = SERVICE_DROP_CONFIG
             line2 = line.copy()
-            fw.write(glm.get_line(line_class, phase, line2, config, sub))
+            blocks.append(glm.get_line(line_class, phase, line2, config, sub))
+    return ''.join(blocks)
 
-    fw.write('// nodes\n')
+
+def get_grid_nodes(grid_lines):
     grid_nodes = dict()
     for sub, lines in grid_lines.items():
         nodes = set()
@@ -99,33 +138,126 @@ def write_glm(topology_json, config_json, time_step, data_csv, file_dir):
             nodes.add(line['a'])
             nodes.add(line['b'])
         grid_nodes[sub] = nodes
-    for sub, nodes in grid_nodes.items():
-        phase = grid_config['area2phase'][sub]
-        measurement = {'voltage':120,'power_1':100+100j}
-        for node in nodes:
-            if node in grid_config['fixed_measurement']:
-                measurement = grid_config['fixed_measurement'][node]
-            elif node in grid_config['measure_id']:
-                measure_id = grid_config['measure_id'][node]
-                if measure_id in measure_snapshot:
-                    measurement = measure_snapshot[measure_id]
-                elif measure_id in grid_config['fixed_measurement']:
-                    measurement = grid_config['fixed_measurement'][measure_id]
+    return grid_nodes
+
+
+class NodeInjectionIndex():
+    """Map every node to its meter column or fixed measurement once, to render the nodes of many snapshots.
+
+    Nodes with fixed measurement are rendered when the index is built. Per snapshot the meter readings are
+    gathered into arrays, and only the measured values are formatted into the precomputed node templates.
+    Nodes whose meter is missing from the snapshot, and unidentified nodes, take the measurement of the previous
+    node of their area (or DEFAULT_MEASUREMENT), rendered by a pass over their areas only.
+    """
+    def __init__(self, grid_config, grid_nodes):
+        glm = GlmFormat()
+        # the measured keys, in the order get_measurement (hence the old per node rendering) yields them
+        self.keys = get_measurement(120.0, 0.0, 0.0).keys()
+        tail = ''.join('\t%s %%s;\n' % key for key in self.keys) + '}\n\n'
+        self.blocks = []
+        self.nodes = []
+        self.fixed = []
+        self.pos2meter = dict()
+        self.unidentified_pos = []
+        self.areas = []
+        self.meters = []
+        self.measured_pos = []
+        self.measured_col = []
+        self.templates = []
+        meter2col = dict()
+        for sub, nodes in grid_nodes.items():
+            phase = grid_config['area2phase'][sub]
+            object_class = 'node' if 'mv' in sub else 'triplex_node'
+            start = len(self.blocks)
+            for node in nodes:
+                meter = None
+                measurement = None
+                if node in grid_config['fixed_measurement']:
+                    measurement = grid_config['fixed_measurement'][node]
+                elif node in grid_config['measure_id']:
+                    measure_id = grid_config['measure_id'][node]
+                    if measure_id in grid_config['fixed_measurement']:
+                        measurement = grid_config['fixed_measurement'][measure_id]
+                    else:
+                        meter = measure_id
                 else:
-                    print 'unmeasured node', node, measure_id
-            else:
-                print 'unidentified node', node
-            if 'mv' in sub:
-                fw.write(glm.get_normal_node(phase, node, measurement))
-            else:
-                fw.write(glm.get_triplex_node(phase, node, measurement))
+                    self.unidentified_pos.append(len(self.blocks))
+                self.nodes.append(node)
+                self.fixed.append(measurement)
+                if meter is None:
+                    block = None
+                    if measurement is not None:
+                        block = glm._get_node(object_class, phase, node, measurement)
+                    self.blocks.append(block)
+                    continue
+                if meter not in meter2col:
+                    meter2col[meter] = len(self.meters)
+                    self.meters.append(meter)
+                prefix = glm._get_node(object_class, phase, node, {})[:-len('}\n\n')]
+                self.pos2meter[len(self.blocks)] = meter
+                self.measured_pos.append(len(self.blocks))
+                self.measured_col.append(meter2col[meter])
+                self.templates.append(prefix.replace('%', '%%') + tail)
+                self.blocks.append(None)
+            self.areas.append((start, len(self.blocks), object_class, phase))
+        self.measured_col = numpy.array(self.measured_col, dtype=int)
+
+    def gather(self, measure_snapshot):
+        """Return {key: array of the value of every measured node} and whether each meter is in the snapshot."""
+        n_meter = len(self.meters)
+        meter_values = dict((key, numpy.zeros(n_meter, dtype=complex)) for key in self.keys)
+        present = numpy.zeros(n_meter, dtype=bool)
+        for col, meter in enumerate(self.meters):
+            measurement = measure_snapshot.get(meter)
+            if measurement is None:
+                continue
+            present[col] = True
+            for key in self.keys:
+                meter_values[key][col] = complex(measurement[key])
+        return dict((key, values[self.measured_col]) for key, values in meter_values.items()), present
+
+    def render(self, measure_snapshot):
+        node_values, present = self.gather(measure_snapshot)
+        columns = [format_complex(node_values[key]) for key in self.keys]
+        blocks = list(self.blocks)
+        for pos, template, values in zip(self.measured_pos, self.templates, zip(*columns)):
+            blocks[pos] = template % values
+        unmeasured_pos = [self.measured_pos[i] for i in numpy.flatnonzero(~present[self.measured_col])]
+        if len(unmeasured_pos) + len(self.unidentified_pos) > 0:
+            self._render_unmeasured(blocks, measure_snapshot, set(unmeasured_pos + self.unidentified_pos))
+        return '// nodes\n' + ''.join(blocks)
+
+    def _render_unmeasured(self, blocks, measure_snapshot, unmeasured):
+        """Render the unmeasured nodes with the measurement carried over from the previous node of their area."""
+        glm = GlmFormat()
+        for start, stop, object_class, phase in self.areas:
+            if not any(start <= pos < stop for pos in unmeasured):
+                continue
+            measurement = DEFAULT_MEASUREMENT
+            for pos in range(start, stop):
+                if self.fixed[pos] is not None:
+                    measurement = self.fixed[pos]
+                elif pos not in unmeasured:
+                    measurement = measure_snapshot[self.pos2meter[pos]]
+                else:
+                    if pos in self.pos2meter:
+                        print 'unmeasured node', self.nodes[pos], self.pos2meter[pos]
+                    else:
+                        print 'unidentified node', self.nodes[pos]
+                    blocks[pos] = glm._get_node(object_class, phase, self.nodes[pos], measurement)
 
-    fw.close()
-    return glm_file
+
+def format_complex(values):
+    """Format an array of complex values as GlmFormat._get_object_block does."""
+    return ['%.3f%.3fj' % (real, imag) if imag < -1e-4 else ('%.3f+%.3fj' % (real, imag) if imag > 1e-4 else
+                                                               '%.3f' % real)
+            for real, imag in zip(values.real.tolist(), values.imag.tolist())]
 
 
 def extract_measurement(database, time_step):
     """Read measurement for the time_step from database"""
+    import pandas
+
     # todo read directly from sql
     df = pandas.read_csv(database, sep=",")[['datetime', 'meter','rms_voltage','rms_current','true_power']]
     if type(time_step) is datetime.datetime:
@@ -133,24 +265,65 @@ def extract_measurement(database, time_step):
     df_snapshot = df.loc[df['datetime'] == time_step]
     if df_snapshot.empty:
         return None
+    return get_measure_snapshot(df_snapshot)
+
+
+class MeasurementIndex():
+    """The readings of data.csv indexed by time step, reloaded when the file changes on disk.
+
+    Snapshots are built on first use and cached.
+    """
+    def __init__(self, data_csv):
+        self.data_csv = data_csv
+        self._load()
+
+    def _load(self):
+        import pandas
+
+        self.mtime = os.path.getmtime(self.data_csv)
+        df = pandas.read_csv(self.data_csv, sep=",")[['datetime', 'meter', 'rms_voltage', 'rms_current',
+                                                      'true_power']]
+        self.step2readings = dict(list(df.groupby('datetime')))
+        self.step2snapshot = dict()
+
+    def get_snapshot(self, time_step):
+        """Return the measure snapshot of the time step, None if data.csv has no readings for it."""
+        if os.path.getmtime(self.data_csv) != self.mtime:
+            print 'reloading %s' % self.data_csv
+            self._load()
+        step = str(time_step)
+        if step not in self.step2snapshot:
+            if step not in self.step2readings:
+                return None
+            self.step2snapshot[step] = get_measure_snapshot(self.step2readings[step])
+        return self.step2snapshot[step]
+
+
+def get_measure_snapshot(df_snapshot):
+    """Map each meter to its measurement, given the readings of one time step."""
     measure_snapshot = dict()
     for index, row in df_snapshot.iterrows():
         meter = str(int(row['meter']))   # todo unify the meter names
-        p = row['true_power']
-        s = row['rms_voltage']*row['rms_current']
-        if s**2 < p**2:
-            q = 0
-            print 'ignoring the q for ',
-            print 's=', s, row['rms_voltage'], row['rms_current'],'p=', p
-        else:
-            q = math.sqrt(s**2 - p**2)
-        v_level = 7200.0
-        if 100 < float(row['rms_voltage']) < 150:
-            v_level = 120.0
-        measure_snapshot[meter] = {'nominal_voltage':v_level, 'power_1':complex(p,q)}
+        measure_snapshot[meter] = get_measurement(row['rms_voltage'], row['rms_current'], row['true_power'])
     return measure_snapshot
 
 
+def get_measurement(rms_voltage, rms_current, true_power):
+    """Convert a meter reading to the node measurement."""
+    p = true_power
+    s = rms_voltage*rms_current
+    if s**2 < p**2:
+        q = 0
+        print 'ignoring the q for ',
+        print 's=', s, rms_voltage, rms_current,'p=', p
+    else:
+        q = math.sqrt(s**2 - p**2)
+    v_level = 7200.0
+    if 100 < float(rms_voltage) < 150:
+        v_level = 120.0
+    return {'nominal_voltage':v_level, 'power_1':complex(p,q)}
+
+
 def sort_line_direction(grid_lines, area2transformer):
     """ Sort all lines such that a->b."""
     for sub, lines in grid_lines.items():
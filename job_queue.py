@@ -0,0 +1,251 @@
+"""Distribute (feeder, time step range) jobs over several hosts by a SQLite job queue.
+
+A feeder is a case directory holding topology.json, config.json and measurement.csv; its glm and xml files are
+written to the result/ sub directory. The queue file should live on a directory shared by all hosts. Workers
+claim jobs with a lease and renew it after every time step, so jobs of a crashed worker are claimed again once
+their lease expires, up to MAX_ATTEMPTS times. The coordinator merges the summary rows of all finished jobs.
+
+The claims rely on SQLite file locking, which is unreliable on NFS and similar network file systems, so the
+shared directory must support POSIX locks; otherwise two workers may claim the same job or corrupt the queue.
+"""
+
+from collections import OrderedDict
+import datetime
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+
+from artifacts import ArtifactManager
+from glm_writer import GlmModel, MeasurementIndex
+from simulator import solve_step, get_steps
+
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 5
+STEP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class JobQueue():
+    def __init__(self, db_file, timeout=60):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, timeout=timeout, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS job ("
+                          "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "feeder TEXT NOT NULL, "
+                          "start TEXT NOT NULL, "
+                          "stop TEXT NOT NULL, "
+                          "interval INTEGER NOT NULL, "
+                          "status TEXT NOT NULL DEFAULT 'pending', "
+                          "worker TEXT, "
+                          "lease_expires REAL, "
+                          "attempts INTEGER NOT NULL DEFAULT 0, "
+                          "result TEXT, "
+                          "error TEXT)")
+
+    def submit(self, feeders, start, stop, interval=15, steps_per_job=96):
+        """Split [start, stop) of every feeder into jobs of steps_per_job steps of interval minutes."""
+        span = datetime.timedelta(minutes=interval * steps_per_job)
+        jobs = []
+        for feeder in feeders:
+            job_start = start
+            while job_start < stop:
+                job_stop = min(job_start + span, stop)
+                jobs.append((feeder, job_start.strftime(STEP_FORMAT), job_stop.strftime(STEP_FORMAT), interval))
+                job_start = job_stop
+        self.conn.executemany("INSERT INTO job (feeder, start, stop, interval) VALUES (?, ?, ?, ?)", jobs)
+        return len(jobs)
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """Lease a pending job (or one whose lease expired), return None if there is none.
+
+        Expired jobs that already had max_attempts leases are marked failed instead.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("UPDATE job SET status = 'failed', error = ?, lease_expires = NULL "
+                              "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                              ('lease expired after %d attempts' % max_attempts, now, max_attempts))
+            row = self.conn.execute("SELECT id, feeder, start, stop, interval FROM job "
+                                    "WHERE status = 'pending' "
+                                    "OR (status = 'running' AND lease_expires < ? AND attempts < ?) "
+                                    "ORDER BY id LIMIT 1", (now, max_attempts)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE job SET status = 'running', worker = ?, lease_expires = ?, "
+                                  "attempts = attempts + 1 WHERE id = ?", (worker, now + lease_seconds, row[0]))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {'id': row[0], 'feeder': row[1], 'start': datetime.datetime.strptime(row[2], STEP_FORMAT),
+                'stop': datetime.datetime.strptime(row[3], STEP_FORMAT), 'interval': row[4]}
+
+    def renew(self, job_id, worker, lease_seconds=LEASE_SECONDS):
+        """Extend the lease, return False if the job was claimed by another worker meanwhile."""
+        cursor = self.conn.execute("UPDATE job SET lease_expires = ? "
+                                   "WHERE id = ? AND worker = ? AND status = 'running'",
+                                   (time.time() + lease_seconds, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, rows):
+        cursor = self.conn.execute("UPDATE job SET status = 'done', result = ?, error = NULL "
+                                   "WHERE id = ? AND worker = ? AND status = 'running'",
+                                   (json.dumps(rows, default=str), job_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error, max_attempts=MAX_ATTEMPTS):
+        """Put the job back to the queue, or mark it failed after max_attempts."""
+        self.conn.execute("UPDATE job SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                          "error = ?, lease_expires = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+                          (max_attempts, error, job_id, worker))
+
+    def count(self):
+        """Return {status: number of jobs}."""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM job GROUP BY status").fetchall())
+
+    def results(self):
+        """Return (feeder, summary rows) of all finished jobs."""
+        rows = self.conn.execute("SELECT feeder, result FROM job WHERE status = 'done' ORDER BY id").fetchall()
+        return [(feeder, json.loads(result, object_pairs_hook=OrderedDict)) for feeder, result in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def run_job(job, queue, worker, lease_seconds=LEASE_SECONDS, artifacts=None, models=None):
+    """Solve all steps of the job, return its summary rows or None if the lease was lost.
+
+    Steps without measurement are skipped, a step GridlabD gives no result for raises RuntimeError so the job is
+    failed and retried. models caches the GlmModel and the MeasurementIndex of each feeder across the jobs of a
+    worker.
+    """
+    feeder = job['feeder']
+    file_dir = os.path.join(feeder, 'result', '')
+    topology_json = os.path.join(feeder, 'topology.json')
+    config_json = os.path.join(feeder, 'config.json')
+    data_csv = os.path.join(feeder, 'measurement.csv')
+    if models is None:
+        models = dict()
+    if feeder not in models:
+        models[feeder] = (GlmModel(topology_json, config_json), MeasurementIndex(data_csv))
+    model, measurement = models[feeder]
+    rows = []
+    for step in get_steps(job['start'], job['stop'], job['interval']):
+        measure_snapshot = measurement.get_snapshot(step)
+        if measure_snapshot is not None:
+            result = solve_step(topology_json, config_json, step, data_csv, file_dir, artifacts, model,
+                                measure_snapshot)
+            if result is None:
+                raise RuntimeError('solve failed for %s of %s, GridlabD gave no result' % (step, feeder))
+            rows.append(result)
+        if not queue.renew(job['id'], worker, lease_seconds):
+            print '%s lost the lease of job %d' % (worker, job['id'])
+            return None
+    return rows
+
+
+def run_worker(db_file, worker=None, lease_seconds=LEASE_SECONDS):
+    """Claim and run jobs until the queue has no pending or running jobs left."""
+    if worker is None:
+        worker = '%s-%d' % (socket.gethostname(), os.getpid())
+    queue = JobQueue(db_file)
+    artifacts = ArtifactManager()
+    models = dict()
+    n_job = 0
+    while True:
+        job = queue.claim(worker, lease_seconds)
+        if job is None:
+            count = queue.count()
+            if count.get('pending', 0) + count.get('running', 0) == 0:
+                break
+            # jobs of other workers may still expire and come back
+            time.sleep(POLL_SECONDS)
+            continue
+        print '%s running job %d %s %s-%s' % (worker, job['id'], job['feeder'], job['start'], job['stop'])
+        try:
+            rows = run_job(job, queue, worker, lease_seconds, artifacts, models)
+        except Exception as e:
+            queue.fail(job['id'], worker, repr(e))
+            continue
+        if rows is not None and queue.complete(job['id'], worker, rows):
+            n_job += 1
+    queue.close()
+    artifacts.close()
+    print '%s finished %d jobs, %d disk bytes written' % (worker, n_job, artifacts.disk_bytes)
+    return n_job
+
+
+def merge_results(db_file, summary_csv=None):
+    """Merge the summary rows of all finished jobs, sorted by feeder and timestamp."""
+    import pandas
+
+    queue = JobQueue(db_file)
+    count = queue.count()
+    if count.get('failed', 0) > 0:
+        print '%d failed jobs' % count['failed']
+    frames = []
+    for feeder, rows in queue.results():
+        df = pandas.DataFrame(rows)
+        df.insert(0, 'feeder', feeder)
+        frames.append(df)
+    queue.close()
+    if len(frames) == 0:
+        return None
+    df = pandas.concat(frames, ignore_index=True).sort_values(['feeder', 'timestamp'])
+    if summary_csv is not None:
+        with open(summary_csv, 'w+') as f:
+            df.to_csv(f, sep=",")
+    return df
+
+
+def run_local(db_file, n_workers=None, lease_seconds=LEASE_SECONDS):
+    """Run several worker processes on this machine, standing in for remote hosts."""
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    # worker names must be unique across hosts sharing the queue
+    host = socket.gethostname()
+    workers = [multiprocessing.Process(target=run_worker, args=(db_file, '%s-local-%d' % (host, i), lease_seconds))
+               for i in range(n_workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_file')
+    subparsers = parser.add_subparsers(dest='command')
+    submit_parser = subparsers.add_parser('submit')
+    submit_parser.add_argument('start', help='e.g. "2015-09-16 10:00:00"')
+    submit_parser.add_argument('stop')
+    submit_parser.add_argument('feeders', nargs='+', help='case directories, e.g. case/la')
+    submit_parser.add_argument('--interval', type=int, default=15, help='minutes between time steps')
+    submit_parser.add_argument('--steps-per-job', type=int, default=96)
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('--lease', type=int, default=LEASE_SECONDS)
+    local_parser = subparsers.add_parser('local')
+    local_parser.add_argument('--workers', type=int, default=None)
+    local_parser.add_argument('--lease', type=int, default=LEASE_SECONDS)
+    merge_parser = subparsers.add_parser('merge')
+    merge_parser.add_argument('summary_csv')
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        n_job = JobQueue(args.db_file).submit(args.feeders, datetime.datetime.strptime(args.start, STEP_FORMAT),
+                                              datetime.datetime.strptime(args.stop, STEP_FORMAT),
+                                              args.interval, args.steps_per_job)
+        print 'submitted %d jobs' % n_job
+    elif args.command == 'worker':
+        run_worker(args.db_file, lease_seconds=args.lease)
+    elif args.command == 'local':
+        run_local(args.db_file, args.workers, args.lease)
+    elif args.command == 'merge':
+        merge_results(args.db_file, args.summary_csv)
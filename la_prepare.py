@@ -8,10 +8,8 @@ from collections import OrderedDict
 import sys
 import datetime
 
-import pandas
 import json
-import matplotlib.pyplot as plt
-import psycopg2
+# pandas, matplotlib and psycopg2 are imported by the functions using them, topology preparation needs none
 
 # Sql connection
 HOST = ''
@@ -31,7 +29,7 @@ TAG_TRANSFORMER = 'TR'
 TAG_MV_AREA = 'M'
 
 
-def prepare_topology(la_json, topology_json):
+def prepare_topology(la_json, topology_json, rules_json, report_json=None):
     """ Process LA config file to match the specified format.
 
     Processes include:
@@ -41,149 +39,193 @@ def prepare_topology(la_json, topology_json):
     4) add transformers (transformers should be add to some nodes)
     5) assign service drops to each lv subdivision and delete the red entry
     6) convert the lengths to feet
+
+    The areas, redundant lines and transformer nodes are read from rules_json. Every step works on node and edge
+    indexes (linear in the number of lines); the changes are returned as a report and written to report_json.
     """
+    rules = json.load(open(rules_json, 'r'), object_pairs_hook=OrderedDict)
+    report = OrderedDict()
     grid_lines = json.load(open(la_json, 'r'))
-    grid_lines = remove_redundant_lines(grid_lines)
-    grid_lines, transformers = add_transformers(grid_lines)
-    grid_lines = deal_service_drops(grid_lines)
+    grid_lines = remove_redundant_lines(grid_lines, rules, report)
+    grid_lines, transformers = add_transformers(grid_lines, rules, report)
+    grid_lines = deal_service_drops(grid_lines, rules, report)
     grid_lines['tr'] = transformers
-    grid_lines = rename_areas(grid_lines)
-    grid_lines = rename_nodes(grid_lines)
-    grid_lines = convert_length(grid_lines)
+    grid_lines = rename_areas(grid_lines, rules, report)
+    grid_lines = rename_nodes(grid_lines, rules, report)
+    grid_lines = convert_length(grid_lines, rules, report)
 
     with open(topology_json, 'w+') as f:
         json.dump(grid_lines, f, indent=2)
+    if report_json is not None:
+        with open(report_json, 'w+') as f:
+            json.dump(report, f, indent=2)
+    for key, changes in report.items():
+        print '%s: %d' % (key, changes if isinstance(changes, int) else len(changes))
+    return report
+
 
+def remove_redundant_lines(grid_lines, rules, report):
+    """remove redundant lines (errors in the drawing.pdf and the json file).
 
-def remove_redundant_lines(grid_lines):
-    """remove redundant lines (errors in the drawing.pdf and the json file). """
-    remove_lines = [('12', '13'), ('14', '56'), ('86', '65'), ('29', '30'), ('84', '85'), ('24', '31')]
-    combine_lines = ['61', '9', '62']
+    Lines in rules['remove_lines'] are removed, the lines along each chain of rules['combine_lines'] are replaced
+    by a single line from the first to the last node of the chain. Chains not complete in an area are kept.
+    """
+    remove_edges = set(frozenset(pair) for pair in rules['remove_lines'])
+    edge2chain = dict()
+    for i, chain in enumerate(rules['combine_lines']):
+        for j in range(len(chain) - 1):
+            edge2chain[frozenset(chain[j:j + 2])] = i
+    report['removed_lines'] = []
+    report['combined_lines'] = []
+    report['incomplete_chains'] = []
+    matched_edges = set()
     for sub, lines in grid_lines.items():
-        if 'red' in sub or 'pink' in sub:
+        if sub in (rules['mv_area'], rules['service_drop_area']):
             continue
-        combine_lines_lens = []
+        chain2lines = dict()
         newlines = []
         for line in lines:
-            if (line['a'], line['b']) in remove_lines or (line['b'], line['a']) in remove_lines:
-                print 'remove', line, 'in', sub
-                continue
-            if (line['a'], line['b']) == (combine_lines[0], combine_lines[1]) \
-                    or (line['a'], line['b']) == (combine_lines[1], combine_lines[0]):
-                combine_lines_lens.append(line['len'])
+            edge = frozenset((line['a'], line['b']))
+            if edge in remove_edges:
                 print 'remove', line, 'in', sub
+                report['removed_lines'].append([sub, line['a'], line['b']])
+                matched_edges.add(edge)
                 continue
-            if {line['a'], line['b']} == {combine_lines[1], combine_lines[2]}:
-                combine_lines_lens.append(line['len'])
-                print 'remove', line, 'in', sub
+            if edge in edge2chain:
+                chain2lines.setdefault(edge2chain[edge], []).append(line)
+                matched_edges.add(edge)
                 continue
             newlines.append(line)
-        if len(combine_lines_lens) == 2:
-            added_line = {'a': combine_lines[0], 'b': combine_lines[2], 'len': sum(combine_lines_lens)}
+        for i, chain_lines in sorted(chain2lines.items()):
+            chain = rules['combine_lines'][i]
+            if len(chain_lines) != len(chain) - 1:
+                print 'incomplete chain', chain, 'in', sub, 'kept'
+                report['incomplete_chains'].append([sub] + chain)
+                newlines.extend(chain_lines)
+                continue
+            for line in chain_lines:
+                print 'remove', line, 'in', sub
+                report['removed_lines'].append([sub, line['a'], line['b']])
+            added_line = {'a': chain[0], 'b': chain[-1], 'len': sum(line['len'] for line in chain_lines)}
             print 'add', added_line
+            report['combined_lines'].append([sub, chain[0], chain[-1]])
             newlines.append(added_line)
         grid_lines[sub] = newlines
-
+    report['unmatched_rules'] = [sorted(edge) for edge in (remove_edges | set(edge2chain)) - matched_edges]
     return grid_lines
 
 
-def add_transformers(grid_lines, trans_nodes=None):
-    """Add transformers between MV and LV."""
-    if trans_nodes is None:
-        trans_nodes = {'pink': "107", 'blue': "14", 'purple': "88", 'yellow': "44", 'green': "104", 'white': "77"}
+def add_transformers(grid_lines, rules, report):
+    """Add transformers between MV and LV at rules['trans_nodes'] and rename the nodes in the MV area."""
     node2area = dict()
-    for key, val in trans_nodes.items():
-        node2area[val] = key
+    for area, node in rules['trans_nodes'].items():
+        if area == rules['mv_area']:
+            # not rename the MV area
+            continue
+        node2area[node] = area
     transformers = []
     name_map = dict()
-    for line in grid_lines['pink']:
+    for line in grid_lines[rules['mv_area']]:
         for end in ['a', 'b']:
-            if line[end] in trans_nodes.values():
-                if node2area[line[end]] is 'pink':
-                    # not rename the MV area
-                    continue
-                if line[end] in [l1['b'] for l1 in transformers]:
-                    # already counted
-                    continue
+            if line[end] not in node2area:
+                continue
+            if line[end] not in name_map:
                 rename = ''.join((TAG_TRANSFORMER, line[end]))
                 name_map[line[end]] = rename
                 transformers.append(
                     {'a': rename, 'b': line[end], 'transformer': 'split', 'area_low': node2area[line[end]]})
-                line[end] = rename
-    # rename all other occurrences
-    for line in grid_lines['pink']:
-        for end in ['a', 'b']:
-            if line[end] in name_map:
-                line[end] = name_map[line[end]]
+            line[end] = name_map[line[end]]
+    report['transformers'] = [[transformer['a'], transformer['b']] for transformer in transformers]
     return grid_lines, transformers
 
 
-def deal_service_drops(grid_lines):
-    # collect lv nodes
-    sub2nodes = dict()
+def deal_service_drops(grid_lines, rules, report):
+    """Assign the service drops to the LV areas of their pole and delete the service drop area."""
+    # index lv nodes to their areas
+    node2areas = dict()
     for sub, lines in grid_lines.items():
-        if 'red' in sub or 'pink' in sub:
+        if sub in (rules['mv_area'], rules['service_drop_area']):
             continue
-        sub2nodes[sub] = set()
         for line in lines:
-            sub2nodes[sub].add(line['a'])
-            sub2nodes[sub].add(line['b'])
-    # assign service drops to subdivisions
-    for line in grid_lines['red']:
-        regions = []
-        for sub in sub2nodes.keys():
-            if line['a'] in sub2nodes[sub]:
-                line['b'] = line['house']
-                line['sd'] = True
-                del line['house']
-                grid_lines[sub].append(line)
-                regions.append(sub)
+            for end in ['a', 'b']:
+                areas = node2areas.setdefault(line[end], [])
+                if sub not in areas:
+                    areas.append(sub)
+    report['service_drops'] = []
+    report['ambiguous_service_drops'] = []
+    report['unassigned_service_drops'] = []
+    for line in grid_lines[rules['service_drop_area']]:
+        regions = node2areas.get(line['a'], [])
+        if len(regions) == 0:
+            print 'unassigned service drop', line['a'], line['house']
+            report['unassigned_service_drops'].append([line['a'], line['house']])
+            continue
         if len(regions) > 1:
             print regions, line['a'], line['house']
-    del grid_lines['red']
+            report['ambiguous_service_drops'].append([line['a'], line['house']] + regions)
+        line['b'] = line['house']
+        line['sd'] = True
+        del line['house']
+        grid_lines[regions[0]].append(line)
+        report['service_drops'].append([regions[0], line['a'], line['b']])
+    del grid_lines[rules['service_drop_area']]
     return grid_lines
 
 
-def rename_areas(grid_lines, area_map=None):
-    if area_map is None:
-        area_map = {'pink': "mv", 'blue': "lv1", 'purple': "lv2",
-                    'yellow': "lv3", 'green': "lv4", 'white': "lv5"}
+def rename_areas(grid_lines, rules, report):
+    """Rename the areas by rules['area_map'], areas missing from the map are dropped and reported."""
+    area_map = rules['area_map']
+    report['dropped_areas'] = []
+    for color, lines in grid_lines.items():
+        if color != 'tr' and color not in area_map:
+            print 'drop area', color, 'with', len(lines), 'lines, not in area_map'
+            report['dropped_areas'].append([color, len(lines)])
     sub2lines = OrderedDict()
     for color, sub in area_map.items():
         sub2lines[sub] = grid_lines[color]
     for trans in grid_lines['tr']:
         trans['area_low'] = area_map[trans['area_low']]
     sub2lines['tr'] = grid_lines['tr']
+    report['renamed_areas'] = area_map.items()
     return sub2lines
 
 
-def rename_nodes(grid_lines):
+def rename_nodes(grid_lines, rules, report):
+    mv_area = rules['area_map'][rules['mv_area']]
     lv_nodes = set()
     for sub, lines in grid_lines.items():
-        if 'mv' in sub or 'tr' in sub:
+        if sub in (mv_area, 'tr'):
             continue
         for line in lines:
             lv_nodes.add(line['a'])
             lv_nodes.add(line['b'])
     # rename same node in mv area
-    for line in grid_lines['mv']:
+    renamed_nodes = set()
+    for line in grid_lines[mv_area]:
         for end in ['a', 'b']:
             if line[end] in lv_nodes:
+                renamed_nodes.add(line[end])
                 line[end] = ''.join([TAG_MV_AREA, line[end]])
+    report['renamed_nodes'] = sorted(renamed_nodes)
     return grid_lines
 
 
-def convert_length(grid_lines):
+def convert_length(grid_lines, rules, report):
+    converted = 0
     for sub, lines in grid_lines.items():
-        if 'tr' in sub:
+        if sub == 'tr':
             continue
         for line in lines:
             if 'len' in line:
-                line['len'] *= 3.28084
+                line['len'] *= rules['length_scale']
+                converted += 1
+    report['converted_lengths'] = converted
     return grid_lines
 
 
 def write_config(topology_json, config_json):
+    import psycopg2
+
     try:
         conn = psycopg2.connect("host='%s' dbname='%s' user='%s' password='%s'" % HOST, DBNAME, USER, PASSWORD)
     except:
@@ -238,6 +280,10 @@ def write_config(topology_json, config_json):
 
 def measurement_sql_to_csv(config_josn, simulation_steps, data_csv):
     """Draw measurement from sql to csv file."""
+    import matplotlib.pyplot as plt
+    import pandas
+    import psycopg2
+
     try:
         conn = psycopg2.connect("host='sensor-07.andrew.cmu.edu' dbname='respawn' user='respawn' password='firefly'")
     except:
@@ -291,7 +337,7 @@ def measurement_sql_to_csv(config_josn, simulation_steps, data_csv):
 
 
 if __name__ == "__main__":
-    prepare_topology('case/la/raw/la_grid_houses.json', 'case/la/topology.json')
+    prepare_topology('case/la/raw/la_grid_houses.json', 'case/la/topology.json', 'case/la/raw/la_rules.json')
 
     write_config('case/la/topology.json', 'case/la/config.json')
 
@@ -0,0 +1,222 @@
+"""Estimate the line losses of new measurement snapshots by loss sensitivity factors.
+
+The factors are the derivatives of total_loss_real and total_trans_loss_real with respect to the P/Q of
+each meter. They are derived from the radial LV topology at a solved base point and calibrated against the
+losses GridlabD reports for that point, so an estimate is a single dot product with the snapshot.
+Snapshots drifting too far from every base point are solved in full and become a new base point.
+"""
+
+from collections import OrderedDict
+
+import numpy
+
+from glm_writer import GlmModel, MeasurementIndex, LV_CONDUCTOR, SD_CONDUCTOR
+from simulator import solve_step
+
+FEET_PER_MILE = 5280.0
+LV_VOLTAGE = 120.0
+
+# load loss of the transformers, see GlmFormat.get_trans_config (impedance in p.u. of the power rating)
+TRANS_RESISTANCE = 0.006
+TRANS_RATING = 100.0e3
+
+# change of the meter loads between a snapshot and its nearest base point, as a fraction of the feeder load,
+# before falling back to a full solve; about 5% error of the estimated losses on the sample data
+DRIFT_THRESHOLD = 0.35
+MAX_BASES = 4
+
+
+class LossSensitivityModel():
+    def __init__(self, topology_json, config_json, data_csv, file_dir,
+                 drift_threshold=DRIFT_THRESHOLD, max_bases=MAX_BASES):
+        self.topology_json = topology_json
+        self.config_json = config_json
+        self.data_csv = data_csv
+        self.file_dir = file_dir
+        self.drift_threshold = drift_threshold
+        self.max_bases = max_bases
+        self.bases = []
+        self.glm_model = GlmModel(topology_json, config_json)
+        self.measurement = MeasurementIndex(data_csv)
+        grid_config = self.glm_model.grid_config
+        grid_lines = self.glm_model.grid_lines
+
+        # only the LV areas (triplex lines and transformers) contribute to the analyzed losses
+        self.areas = []
+        meters = set()
+        for sub, lines in grid_lines.items():
+            if 'mv' in sub:
+                continue
+            area = {'root': grid_config['area2transformer'][sub], 'lines': [], 'node2meter': dict(),
+                    'fixed_load': dict()}
+            for line in lines:
+                conductor = SD_CONDUCTOR if 'sd' in line else LV_CONDUCTOR
+                resistance = conductor.resistance * max(line['len'], 0) / FEET_PER_MILE
+                area['lines'].append((line['a'], line['b'], resistance))
+                for node in (line['a'], line['b']):
+                    meter = _get_meter(node, grid_config)
+                    if meter is None:
+                        area['fixed_load'][node] = _get_fixed_load(node, grid_config)
+                    else:
+                        area['node2meter'][node] = meter
+                        meters.add(meter)
+            self.areas.append(area)
+        self.meters = sorted(meters)
+        self.meter_index = dict((meter, i) for i, meter in enumerate(self.meters))
+        # number of nodes of each meter in each area, to aggregate the snapshot to transformer loads
+        self.area_weights = numpy.zeros((len(self.areas), len(self.meters)))
+        for j, area in enumerate(self.areas):
+            for meter in area['node2meter'].values():
+                self.area_weights[j, self.meter_index[meter]] += 1
+
+    def add_base(self, time_step, measure_snapshot=None):
+        """Solve the time step by GridlabD and derive the sensitivity factors around it."""
+        if measure_snapshot is None:
+            measure_snapshot = self.measurement.get_snapshot(time_step)
+            if measure_snapshot is None:
+                return None
+        result = solve_step(self.topology_json, self.config_json, time_step, self.data_csv, self.file_dir,
+                            model=self.glm_model, measure_snapshot=measure_snapshot)
+        if result is None:
+            return None
+        x0 = numpy.nan_to_num(self._vectorize(measure_snapshot))
+        self.bases.append(self._get_factors(x0, result))
+        if len(self.bases) > self.max_bases:
+            self.bases.pop(0)
+        result['drift'] = 0.0
+        result['method'] = 'solve'
+        return result
+
+    def estimate(self, time_step):
+        measure_snapshot = self.measurement.get_snapshot(time_step)
+        if measure_snapshot is None:
+            return None
+        return self.estimate_snapshot(time_step, measure_snapshot)
+
+    def estimate_snapshot(self, time_step, measure_snapshot):
+        """Estimate the losses of the snapshot, fall back to a full solve if it drifts too far."""
+        x = self._vectorize(measure_snapshot)
+        base, drift = None, float('inf')
+        for candidate in self.bases:
+            candidate_drift = self._get_drift(x, candidate['x0'])
+            if candidate_drift < drift:
+                base, drift = candidate, candidate_drift
+        if base is None or drift > self.drift_threshold:
+            return self.add_base(time_step, measure_snapshot)
+
+        # unmeasured meters keep their base point values
+        x = numpy.where(numpy.isnan(x), base['x0'], x)
+        total_loss_real = base['line_intercept'] + numpy.dot(base['line_factors'], x)
+        total_power1_real = base['power_intercept'] + numpy.dot(base['power_factors'], x)
+        total_trans_loss_real = base['trans_intercept'] + numpy.dot(base['trans_factors'], x)
+
+        result_dict = OrderedDict()
+        result_dict['timestamp'] = time_step
+        result_dict['total_loss_real'] = float(total_loss_real)
+        result_dict['total_power1_real'] = float(total_power1_real)
+        result_dict['total_trans_loss_real'] = float(total_trans_loss_real)
+        result_dict['percentage'] = 0
+        if total_power1_real > 0:
+            result_dict['percentage'] = '%.3f%%' % float(total_loss_real/total_power1_real*100)
+        result_dict['drift'] = drift
+        result_dict['method'] = 'estimate'
+        return result_dict
+
+    def _vectorize(self, measure_snapshot):
+        """Map the snapshot to [P of each meter, Q of each meter], nan for unmeasured meters."""
+        n_meter = len(self.meters)
+        x = numpy.full(2 * n_meter, numpy.nan)
+        for meter, i in self.meter_index.items():
+            if meter in measure_snapshot:
+                power = complex(measure_snapshot[meter]['power_1'])
+                x[i] = power.real
+                x[n_meter + i] = power.imag
+        return x
+
+    def _get_drift(self, x, x0):
+        """Total change of the node loads between the snapshot and the base point, relative to the feeder load."""
+        n_meter = len(self.meters)
+        x = numpy.where(numpy.isnan(x), x0, x)
+        change = numpy.abs((x[:n_meter] - x0[:n_meter]) + 1j * (x[n_meter:] - x0[n_meter:]))
+        load0 = self.area_weights.dot(x0[:n_meter]) + 1j * self.area_weights.dot(x0[n_meter:])
+        return float(self.area_weights.sum(axis=0).dot(change) / max(numpy.abs(load0).sum(), 1.0))
+
+    def _get_factors(self, x0, result):
+        """Linearize the line and transformer losses at x0, calibrated by the solved result."""
+        n_meter = len(self.meters)
+        line_factors = numpy.zeros(2 * n_meter)
+        trans_factors = numpy.zeros(2 * n_meter)
+        power_factors = numpy.zeros(2 * n_meter)
+        fixed_power = 0.0
+        line_loss = 0.0
+        trans_loss = 0.0
+        trans_k = TRANS_RESISTANCE / TRANS_RATING
+        for area in self.areas:
+            # downstream power of each node, lines are sorted from the transformer to the leaves
+            downstream = dict()
+            for node, load in area['fixed_load'].items():
+                downstream[node] = load
+                fixed_power += load.real
+            for node, meter in area['node2meter'].items():
+                i = self.meter_index[meter]
+                downstream[node] = complex(x0[i], x0[n_meter + i])
+                power_factors[i] += 1
+            flows = []
+            for a, b, resistance in reversed(area['lines']):
+                flows.append(downstream[b])
+                downstream[a] += downstream[b]
+            flows.reverse()
+
+            # loss gradient accumulated along the path from the transformer to each node
+            gradient = {area['root']: 0j}
+            for (a, b, resistance), flow in zip(area['lines'], flows):
+                line_loss += resistance * abs(flow)**2 / LV_VOLTAGE**2
+                gradient[b] = gradient[a] + 2 * resistance * flow / LV_VOLTAGE**2
+            trans_flow = downstream[area['root']]
+            trans_loss += trans_k * abs(trans_flow)**2
+            for node, meter in area['node2meter'].items():
+                i = self.meter_index[meter]
+                line_factors[i] += gradient[node].real
+                line_factors[n_meter + i] += gradient[node].imag
+                trans_factors[i] += 2 * trans_k * trans_flow.real
+                trans_factors[n_meter + i] += 2 * trans_k * trans_flow.imag
+
+        # line losses are pure I^2R, so scale them; transformer losses keep their no-load part as intercept
+        if line_loss > 0:
+            line_factors *= result['total_loss_real'] / line_loss
+        base = dict()
+        base['x0'] = x0
+        base['line_factors'] = line_factors
+        base['line_intercept'] = result['total_loss_real'] - numpy.dot(line_factors, x0)
+        base['trans_factors'] = trans_factors
+        base['trans_intercept'] = result['total_trans_loss_real'] - numpy.dot(trans_factors, x0)
+        base['power_factors'] = power_factors
+        base['power_intercept'] = fixed_power
+        return base
+
+
+def _get_meter(node, grid_config):
+    """Return the meter measuring the node, None if the node has a fixed measurement."""
+    if node in grid_config['fixed_measurement']:
+        return None
+    measure_id = grid_config['measure_id'].get(node)
+    if measure_id is None or measure_id in grid_config['fixed_measurement']:
+        return None
+    return measure_id
+
+
+def _get_fixed_load(node, grid_config):
+    measurement = grid_config['fixed_measurement'].get(node)
+    if measurement is None:
+        measurement = grid_config['fixed_measurement'].get(grid_config['measure_id'].get(node), {})
+    return complex(measurement.get('power_1', 0))
+
+
+if __name__ == "__main__":
+    import datetime
+
+    model = LossSensitivityModel('case/la/topology.json', 'case/la/config.json', 'case/la/measurement.csv',
+                                 'case/la/result/')
+    steps = [datetime.datetime(2015, 9, 20, hour=10, minute=m, second=0) for m in range(0, 60, 15)]
+    for step in steps:
+        print model.estimate(step)
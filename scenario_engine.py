@@ -0,0 +1,205 @@
+"""Monte Carlo scenarios for the missing and suspect meters of a time step.
+
+The loads of missing and suspect meters are sampled from their history in data.csv (or from the readings of
+all meters if a meter has no usable history). The readings and the history are loaded once by MeterHistory and
+reused for every time step. Each scenario is written, solved and analyzed like a normal
+time step; scenarios are dispatched in batches to a worker pool and summarized to loss distributions. Every
+worker loads the GlmModel once and only renders the nodes of each scenario.
+"""
+
+from collections import OrderedDict
+import json
+import multiprocessing
+import os
+
+import numpy
+import pandas
+
+from glm_writer import GlmModel, get_measurement
+from simulator import run_gridlabd
+from xml_analyzer import analyze_xml
+
+N_SCENARIO = 200
+BATCH_SIZE = 10
+PERCENTILES = [5, 50, 95]
+
+# plausible rms voltages of the LV and MV meters, readings outside are suspect
+VOLTAGE_BANDS = [(100.0, 150.0), (6000.0, 8000.0)]
+
+SUMMARY_KEYS = ['total_loss_real', 'total_power1_real', 'total_trans_loss_real']
+READING_COLUMNS = ['rms_voltage', 'rms_current', 'true_power']
+
+# GlmModel of the worker process, see _init_worker
+_model = None
+
+
+class MeterHistory():
+    """The readings of data.csv by time step and the plausible readings of each meter, loaded once.
+
+    history maps each meter to its plausible readings (rows of READING_COLUMNS in time order), pooled holds the
+    plausible readings of all meters; the history of each meter is a slice of pooled.
+    """
+    def __init__(self, data_csv):
+        df = pandas.read_csv(data_csv, sep=",")[['datetime', 'meter'] + READING_COLUMNS]
+        df['meter'] = df['meter'].astype(int).astype(str)
+        self.step2readings = dict(list(df.groupby('datetime')))
+        self.history, self.pooled = get_meter_history(df)
+
+
+def run_scenarios(topology_json, config_json, time_step, data_csv, file_dir, n_scenario=N_SCENARIO,
+                  batch_size=BATCH_SIZE, processes=None, seed=None, meter_history=None):
+    """Solve n_scenario scenarios of the time step and return the distribution of the losses.
+
+    Pass the MeterHistory of data_csv when running many time steps.
+    """
+    if meter_history is None:
+        meter_history = MeterHistory(data_csv)
+    df_snapshot = meter_history.step2readings.get(str(time_step))
+    if df_snapshot is None:
+        return None
+
+    grid_config = json.load(open(config_json))
+    meters = set(meter for meter in grid_config['measure_id'].values()
+                 if meter not in grid_config['fixed_measurement'])
+    measure_snapshot, missing, suspect = check_snapshot(meters, df_snapshot)
+    print '%s: %d missing meters, %d suspect meters' % (time_step, len(missing), len(suspect))
+
+    uncertain = sorted(missing | suspect)
+    scenarios = sample_scenarios(uncertain, meter_history.history, n_scenario, seed, meter_history.pooled)
+    if len(uncertain) == 0:
+        # nothing to sample, a single scenario gives the exact losses
+        scenarios = scenarios[:1]
+
+    tasks = []
+    for first in range(0, len(scenarios), batch_size):
+        tasks.append((time_step, file_dir, measure_snapshot, scenarios[first:first + batch_size], first))
+    if processes == 1:
+        _init_worker(topology_json, config_json)
+        batches = map(_solve_batch, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (topology_json, config_json))
+        try:
+            batches = pool.map(_solve_batch, tasks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    results = [result for batch in batches for result in batch if result is not None]
+    return summarize_scenarios(time_step, results, len(missing), len(suspect))
+
+
+def check_snapshot(meters, df_snapshot):
+    """Split the readings of the snapshot into plausible measurements, missing and suspect meters."""
+    readings = df_snapshot.loc[df_snapshot['meter'].isin(meters)]
+    plausible = get_plausible(readings)
+    suspect = set(readings.loc[~plausible, 'meter'])
+    readings = readings.loc[plausible]
+    measure_snapshot = dict()
+    for meter, rms_voltage, rms_current, true_power in zip(readings['meter'], readings['rms_voltage'],
+                                                           readings['rms_current'], readings['true_power']):
+        measure_snapshot[meter] = get_measurement(rms_voltage, rms_current, true_power)
+    missing = meters - set(measure_snapshot.keys()) - suspect
+    return measure_snapshot, missing, suspect
+
+
+def get_plausible(df):
+    """Return the mask of the plausible readings of df."""
+    rms_voltage, rms_current, true_power = df['rms_voltage'], df['rms_current'], df['true_power']
+    plausible = df[READING_COLUMNS].notnull().all(axis=1) & (true_power >= 0) & (rms_current >= 0)
+    in_band = pandas.Series(False, index=df.index)
+    for low, high in VOLTAGE_BANDS:
+        in_band |= (rms_voltage > low) & (rms_voltage < high)
+    # the apparent power can not be less than the true power
+    return plausible & in_band & ((rms_voltage*rms_current)**2 >= true_power**2)
+
+
+def get_meter_history(df):
+    """Return {meter: array of its plausible readings} and the array of all plausible readings.
+
+    The readings are rows of READING_COLUMNS, in the order of df for each meter.
+    """
+    df = df.loc[get_plausible(df)].sort_values('meter', kind='mergesort')
+    pooled = df[READING_COLUMNS].values
+    meters = df['meter'].values
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(meters[1:] != meters[:-1]) + 1, [len(meters)]))
+    history = dict((meters[start], pooled[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:]))
+    return history, pooled
+
+
+def sample_scenarios(meters, history, n_scenario, seed=None, pooled=None):
+    """Sample the measurement of each meter from its history, return a list of {meter: measurement}.
+
+    history maps each meter to its readings; meters without history are sampled from pooled (by default the
+    readings of all meters).
+    """
+    random = numpy.random.RandomState(seed)
+    if pooled is None:
+        pooled = numpy.concatenate(history.values()) if len(history) > 0 else numpy.zeros((0, 3))
+    scenarios = [dict() for i in range(n_scenario)]
+    for meter in meters:
+        candidates = history.get(meter, pooled)
+        if len(candidates) == 0:
+            print 'no history for meter', meter
+            continue
+        for scenario, i in zip(scenarios, random.randint(len(candidates), size=n_scenario)):
+            scenario[meter] = get_measurement(*candidates[i])
+    return scenarios
+
+
+def summarize_scenarios(time_step, results, n_missing=0, n_suspect=0):
+    summary = OrderedDict()
+    summary['timestamp'] = time_step
+    summary['n_scenario'] = len(results)
+    summary['n_missing'] = n_missing
+    summary['n_suspect'] = n_suspect
+    for key in SUMMARY_KEYS:
+        values = numpy.array([result[key] for result in results], dtype=float)
+        summary[key + '_mean'] = values.mean() if len(values) > 0 else numpy.nan
+        summary[key + '_std'] = values.std() if len(values) > 0 else numpy.nan
+        for percentile in PERCENTILES:
+            summary['%s_p%d' % (key, percentile)] = numpy.percentile(values, percentile) \
+                if len(values) > 0 else numpy.nan
+    return summary
+
+
+def _init_worker(topology_json, config_json):
+    """Load the GlmModel once per worker process."""
+    global _model
+    _model = GlmModel(topology_json, config_json)
+
+
+def _solve_batch(task):
+    """Write, solve and analyze a batch of scenarios in a worker, the scenario files are removed afterwards."""
+    time_step, file_dir, measure_snapshot, scenarios, first = task
+    results = []
+    for i, scenario in enumerate(scenarios):
+        snapshot = dict(measure_snapshot)
+        snapshot.update(scenario)
+        scenario_files = [_model.write_glm(time_step, snapshot, file_dir, tag='-s%04d' % (first + i))]
+        try:
+            scenario_files.append(run_gridlabd(scenario_files[0]))
+            results.append(analyze_xml(scenario_files[1], time_step))
+        finally:
+            for scenario_file in scenario_files:
+                if os.path.exists(scenario_file):
+                    os.remove(scenario_file)
+    return results
+
+
+if __name__ == "__main__":
+    import datetime
+
+    steps = [datetime.datetime(2015, 9, 20, hour=10, minute=m, second=0) for m in range(0, 60, 15)]
+    meter_history = MeterHistory('case/la/measurement.csv')
+    df = pandas.DataFrame()
+    for step in steps:
+        summary = run_scenarios('case/la/topology.json', 'case/la/config.json', step, 'case/la/measurement.csv',
+                                'case/la/result/', seed=0, meter_history=meter_history)
+        if summary is None:
+            print 'no such file - %s' % step
+            continue
+        df = df.append([summary])
+    with open('case/la/result/line_loss_scenarios.csv', 'w+') as f:
+        df.to_csv(f, sep=",")
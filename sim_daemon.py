@@ -0,0 +1,142 @@
+"""Long-lived simulation daemon keeping the parsed model in memory.
+
+The topology, config, glm template (everything but the nodes), node injection index and measurement index are
+loaded once, so a request only renders the nodes of its time step, solves it by GridlabD and analyzes the xml.
+The measurement index is reloaded when data.csv changes on disk, the glm and xml files are released by an
+ArtifactManager if given. Requests are served over HTTP on the local host:
+
+    GET /solve?step=2015-09-16 10:15:00                                   -> summary row
+    GET /solve?start=2015-09-16 10:00:00&stop=2015-09-16 11:00:00&interval=15 -> list of summary rows
+    GET /status                                                            -> model info
+
+A time step without measurement is answered with 404, a bad request with 400 and a failed solve with 500.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import datetime
+import json
+import time
+import traceback
+import urlparse
+
+from artifacts import ArtifactManager
+from glm_writer import GlmModel, MeasurementIndex
+from simulator import run_gridlabd
+from xml_analyzer import analyze_xml
+
+HOST = '127.0.0.1'
+PORT = 8765
+STEP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class SimulationModel():
+    def __init__(self, topology_json, config_json, data_csv, file_dir, artifacts=None):
+        self.data_csv = data_csv
+        self.file_dir = file_dir
+        self.artifacts = artifacts
+        if artifacts is not None:
+            self.file_dir = artifacts.stage_dir
+        self.glm_model = GlmModel(topology_json, config_json)
+        self.measurement = MeasurementIndex(data_csv)
+
+    def write_glm(self, time_step):
+        measure_snapshot = self.measurement.get_snapshot(time_step)
+        if measure_snapshot is None:
+            return None
+        return self.glm_model.write_glm(time_step, measure_snapshot, self.file_dir)
+
+    def solve(self, time_step):
+        """Write, solve and analyze the time step, return its summary row or None without measurement.
+
+        Raises RuntimeError if GridlabD gives no result.
+        """
+        glm_file = self.write_glm(time_step)
+        if glm_file is None:
+            return None
+        xml_file = None
+        disk_bytes = None
+        try:
+            xml_file = run_gridlabd(glm_file)
+            result = analyze_xml(xml_file, time_step)
+        finally:
+            if self.artifacts is not None:
+                disk_bytes = self.artifacts.release([glm_file, xml_file])
+        if result is None:
+            raise RuntimeError('solve failed for %s, GridlabD gave no result' % time_step)
+        if disk_bytes is not None:
+            result['disk_bytes'] = disk_bytes
+        return result
+
+    def solve_range(self, start, stop, interval=15):
+        """Solve the time steps in [start, stop) every interval minutes, skipping those without measurement."""
+        if interval <= 0:
+            raise ValueError('interval must be positive, got %d' % interval)
+        results = []
+        step = start
+        while step < stop:
+            result = self.solve(step)
+            if result is not None:
+                results.append(result)
+            step += datetime.timedelta(minutes=interval)
+        return results
+
+
+class SimulationHandler(BaseHTTPRequestHandler):
+    model = None
+
+    def do_GET(self):
+        t = time.time()
+        url = urlparse.urlparse(self.path)
+        query = dict((key, values[0]) for key, values in urlparse.parse_qs(url.query).items())
+        try:
+            if url.path == '/status':
+                self._reply(200, {'steps': len(self.model.measurement.step2readings),
+                                  'nodes': len(self.model.glm_model.node_index.blocks),
+                                  'data_csv': self.model.data_csv})
+            elif url.path == '/solve' and 'step' in query:
+                result = self.model.solve(datetime.datetime.strptime(query['step'], STEP_FORMAT))
+                if result is None:
+                    self._reply(404, {'error': 'no measurement for %s' % query['step']})
+                else:
+                    self._reply(200, result)
+            elif url.path == '/solve' and 'start' in query and 'stop' in query:
+                self._reply(200, self.model.solve_range(datetime.datetime.strptime(query['start'], STEP_FORMAT),
+                                                        datetime.datetime.strptime(query['stop'], STEP_FORMAT),
+                                                        int(query.get('interval', 15))))
+            else:
+                self._reply(400, {'error': 'unknown request %s' % self.path})
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self._reply(500, {'error': str(e)})
+        print '%s %.3f s' % (self.path, time.time() - t)
+
+    def _reply(self, code, data):
+        body = json.dumps(data, default=str)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(model, host=HOST, port=PORT):
+    SimulationHandler.model = model
+    server = HTTPServer((host, port), SimulationHandler)
+    print 'serving %s:%d' % (host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    t = time.time()
+    artifacts = ArtifactManager()
+    model = SimulationModel('case/la/topology.json', 'case/la/config.json', 'case/la/measurement.csv',
+                            'case/la/result/', artifacts)
+    print 'model loaded in %.3f s' % (time.time() - t)
+    serve(model)
+    artifacts.close()
@@ -2,13 +2,57 @@ import os
 import time
 import datetime
 
-import pandas
-
-from glm_writer import write_glm
+from artifacts import ArtifactManager
 from xml_analyzer import analyze_xml
 
 
+def run_gridlabd(glm_file):
+    """Calculate power flow of the glm file by GridlabD, return the output xml file."""
+    xml_file = glm_file.replace('.glm', '.xml')
+    os.system('gridlabd %s --output %s' % (glm_file, xml_file))
+    return xml_file
+
+
+def get_steps(start, stop, interval=15):
+    """Return the time steps in [start, stop) every interval minutes."""
+    steps = []
+    step = start
+    while step < stop:
+        steps.append(step)
+        step += datetime.timedelta(minutes=interval)
+    return steps
+
+
+def solve_step(topology_json, config_json, time_step, data_csv, file_dir, artifacts=None, model=None,
+               measure_snapshot=None):
+    """Write, solve and analyze a single time step, return the line loss summary row.
+
+    With an ArtifactManager the files are staged in its directory instead of file_dir and released after the
+    analysis, the row then reports the disk bytes written. Pass the GlmModel of the case when solving many steps,
+    and measure_snapshot to solve it instead of the readings of data_csv.
+    """
+    # glm_writer (numpy) is imported here, so run_gridlabd and get_steps load no heavy modules
+    from glm_writer import write_glm
+
+    if artifacts is not None:
+        file_dir = artifacts.stage_dir
+    glm_file = write_glm(topology_json, config_json, time_step, data_csv, file_dir, measure_snapshot, model=model)
+    if glm_file is None:
+        return None
+    xml_file = run_gridlabd(glm_file)
+    result = analyze_xml(xml_file, time_step)
+    if artifacts is not None:
+        disk_bytes = artifacts.release([glm_file, xml_file])
+        if result is not None:
+            result['disk_bytes'] = disk_bytes
+    return result
+
+
 if __name__ == "__main__":
+    import pandas
+
+    from glm_writer import GlmModel
+
     topology_json = 'case/la/topology.json'
     config_json = 'case/la/config.json'
     data_csv = 'case/la/measurement.csv'
@@ -17,43 +61,27 @@ if __name__ == "__main__":
         for hr in range(10, 11):
             steps += [datetime.datetime(2015, 9, day, hour=hr, minute=m, second=0) for m in range(0, 60, 15)]
     file_dir = 'case/la/result/'
+    # intermediate files are staged in memory and released as soon as each step is analyzed,
+    # set archive_dir to keep gzip copies
+    artifacts = ArtifactManager(archive_dir=None)
+    model = GlmModel(topology_json, config_json)
 
-    # write glm files
-    t1 = time.time()
-    step2glm = dict()
-    for step in steps:
-        glm_file = write_glm(topology_json, config_json, step, data_csv, file_dir)
-        if glm_file is None:
-            print 'no such file - %s' % step
-            continue
-        step2glm[step] = glm_file
-    print 'write glm avg time %f s' % (float(time.time()-t1)/len(steps))
-
-    # calculate power flow by GridlabD
-    t2 = time.time()
-    step2xml = dict()
-    for step, glm_file in step2glm.items():
-        xml_file = glm_file.replace('.glm', '.xml')
-        os.system('gridlabd %s --output %s' % (glm_file, xml_file))
-        step2xml[step] = xml_file
-    print 'cal pf avg time %f s' % (float(time.time()-t2)/len(step2glm))
-
-    # analyze xml file
-    t3 = time.time()
+    # write, solve and analyze each step
+    t = time.time()
     df = pandas.DataFrame(columns=['timestamp', 'total_loss_real', 'total_power1_real',
-                                   'percentage', 'total_trans_loss_real'])
-    for step, xml_file in step2xml.items():
-        result = analyze_xml(xml_file, step)
-        if result is None:
-            continue
-        df = df.append([result])
-    print 'analyze xml avg time %fs' % (float(time.time()-t3)/len(steps))
-
-    # save line loss summary and delete other files
+                                   'percentage', 'total_trans_loss_real', 'disk_bytes'])
+    try:
+        for step in steps:
+            result = solve_step(topology_json, config_json, step, data_csv, file_dir, artifacts, model)
+            if result is None:
+                print 'no such file - %s' % step
+                continue
+            df = df.append([result])
+    finally:
+        artifacts.close()
+    print 'solve step avg time %f s' % (float(time.time()-t)/len(steps))
+    print 'disk bytes written %d' % artifacts.disk_bytes
+
+    # save line loss summary
     with open(file_dir + 'line_loss_summary.csv', 'w+') as f:
         df.to_csv(f, sep=",")
-
-    # todo delete the glm and xml files if necessary
-
-
-
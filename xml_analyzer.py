@@ -1,4 +1,5 @@
 import os
+import gzip
 import math
 import re
 import cmath
@@ -10,7 +11,10 @@ import xml.etree.ElementTree as ET
 def analyze_xml(result_xml, time_step):
     if not os.path.exists(result_xml):
         return None
-    tree = ET.parse(result_xml)
+    if result_xml.endswith('.gz'):
+        tree = ET.parse(gzip.open(result_xml))
+    else:
+        tree = ET.parse(result_xml)
     root = tree.getroot()
 
     total_loss_real = 0